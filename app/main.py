@@ -1,8 +1,13 @@
+import asyncio
+from typing import Annotated
 from fastapi import FastAPI, HTTPException, Path, Query, UploadFile, File
-from .models import UploadResponse, SummaryResponse, ClearResponse
+from fastapi.responses import ORJSONResponse
+from .models import UploadResponse, SummaryResponse, ClearResponse, IsoDate
 from .storage import Database
 
-app = FastAPI()
+# Responses are serialised with orjson. Endpoints return ORJSONResponse directly so their dicts skip pydantic validation,
+# the response models are only used to document each endpoint
+app = FastAPI(default_response_class=ORJSONResponse)
 
 db = Database()
 
@@ -21,7 +26,7 @@ async def root():
         }
     }
 
-@app.post("/upload", response_model=UploadResponse)
+@app.post("/upload", responses={200: {"model": UploadResponse}})
 async def upload(file: UploadFile = File(...)):
     # Ensure inputted file is a csv file before attempting upload
     if not file.filename.endswith('.csv'):
@@ -29,7 +34,7 @@ async def upload(file: UploadFile = File(...)):
 
     # Attempt file upload
     try:
-        return await db.upload_csv(file)
+        return ORJSONResponse(await db.upload_csv(file))
     
     # Catch client side error
     except ValueError as e: 
@@ -39,18 +44,23 @@ async def upload(file: UploadFile = File(...)):
     except Exception as e:
         raise HTTPException(500, detail=f"Server error: {str(e)}")
 
-@app.get("/summary/{user_id}", response_model=SummaryResponse)
-async def summary(user_id: int = Path(..., ge=1, description="User ID (positive integer)"),
-                start_date: str = Query(..., pattern=r'^\d{4}-\d{2}-\d{2}$', description="Start date (YYYY-MM-DD) Example: 2024-01-31"),
-                end_date: str = Query(..., pattern=r'^\d{4}-\d{2}-\d{2}$', description="End date (YYYY-MM-DD) Example: 2025-12-31")):
+@app.get("/summary/{user_id}", responses={200: {"model": SummaryResponse}})
+async def summary(user_id: Annotated[int, Path(ge=1, description="User ID (positive integer)")],
+                start_date: Annotated[IsoDate, Query(description="Start date (YYYY-MM-DD) Example: 2024-01-31")],
+                end_date: Annotated[IsoDate, Query(description="End date (YYYY-MM-DD) Example: 2025-12-31")]):
     
-    # Ensure date range has been inputted correctly - String comparison works with ISO formatting
+    # Ensure date range has been inputted correctly - Both dates are already parsed so can be compared directly
     if start_date > end_date:
         raise HTTPException(400, f"start date ({start_date}) cannot be after end date ({end_date})")
     
+    # Answer cached summaries straight away, only sending cache misses to a worker thread so the query never blocks the event loop
+    cached = db.cached_summary(user_id, start_date, end_date)
+    if cached is not None:
+        return ORJSONResponse(cached)
+
     # Attempt to get summary
     try:
-        return db.get_summary(user_id, start_date, end_date)
+        return ORJSONResponse(await asyncio.to_thread(db.get_summary, user_id, start_date, end_date))
     
     # Catch transactions not found error
     except ValueError as e:
@@ -60,11 +70,12 @@ async def summary(user_id: int = Path(..., ge=1, description="User ID (positive
     except Exception as e:
         raise HTTPException(500, detail=f"Server Error: {str(e)}")
     
-@app.delete("/clear", response_model=ClearResponse, description="Used for testing - Executing this endpoint will clear your database")
+@app.delete("/clear", responses={200: {"model": ClearResponse}}, description="Used for testing - Executing this endpoint will clear your database")
 async def clear():
     # Ensure there is data to clear before clearing
     if not db:
-        return {"success": False,
-                "message": "No data to clear"}
+        return ORJSONResponse({"success": False,
+                               "message": "No data to clear"})
     else:
-        return db.clear()
\ No newline at end of file
+        # Run in a worker thread as clearing may have to wait for an upload to finish
+        return ORJSONResponse(await asyncio.to_thread(db.clear))
\ No newline at end of file
@@ -1,4 +1,19 @@
-from pydantic import BaseModel, Field
+import re
+from datetime import date
+from typing import Annotated
+from pydantic import BaseModel, BeforeValidator, Field
+
+# Date format accepted by the summary endpoint, compiled once at import time
+_ISO_DATE = re.compile(r'[0-9]{4}-[0-9]{2}-[0-9]{2}')
+
+def _parse_iso_date(value):
+    # Only accept plain YYYY-MM-DD strings, parsing them straight into a date object
+    if not isinstance(value, str) or not _ISO_DATE.fullmatch(value):
+        raise ValueError("Date must be in YYYY-MM-DD format")
+    return date.fromisoformat(value)
+
+# Date query parameter type, parsed once by pydantic so endpoints can compare date objects directly
+IsoDate = Annotated[date, BeforeValidator(_parse_iso_date)]
 
 class SummaryResponse(BaseModel):
     user_id: int
@@ -6,8 +21,8 @@ class SummaryResponse(BaseModel):
     max_amount: float = Field(..., description="Maximum transaction amount")
     min_amount: float = Field(..., description="Minimum transaction amount")
     mean_amount: float = Field(..., description="Mean transaction amount")
-    start_date: str
-    end_date: str
+    start_date: date
+    end_date: date
 
 class UploadResponse(BaseModel):
     success: bool
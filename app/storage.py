@@ -1,9 +1,85 @@
+import asyncio
 import sqlite3
-import pandas as pd
+import threading
+from collections import OrderedDict
+from typing import BinaryIO
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pacsv
 from fastapi import UploadFile
 import time
+from datetime import date
 from .models import UploadResponse, SummaryResponse, ClearResponse
 
+# Expected CSV columns, in order, and the types pyarrow should parse them as.
+# Timestamps are parsed by Arrow's vectorised ISO-8601 parser at microsecond precision so fractional seconds are accepted,
+# then floored to whole seconds when rows are built
+_COLUMN_TYPES = {
+    'transaction_id': pa.string(),
+    'user_id': pa.int32(),
+    'product_id': pa.int32(),
+    'timestamp': pa.timestamp('us'),
+    'transaction_amount': pa.float32()
+}
+
+def _batch_rows(batch: pa.RecordBatch, uid: np.ndarray, pid: np.ndarray, amt: np.ndarray, step: int):
+    # Lazily yield plain python row tuples for a batch, converting step rows at a time through numpy.
+    # executemany pulls rows from this generator as it goes, so only one slice of python objects is alive at once
+    transaction_ids = batch.column('transaction_id')
+    timestamps = batch.column('timestamp')
+    for offset in range(0, batch.num_rows, step):
+        end = offset + step
+        yield from zip(
+            transaction_ids.slice(offset, step).to_numpy(zero_copy_only=False).tolist(),
+            uid[offset:end].tolist(),
+            pid[offset:end].tolist(),
+            timestamps.slice(offset, step).to_numpy().astype('datetime64[s]').astype('int64').tolist(), # Stored as epoch seconds
+            amt[offset:end].tolist()
+        )
+
+def _has_invalid_values(uid: np.ndarray, pid: np.ndarray, amt: np.ndarray) -> bool:
+    # Check for any non-positive ID or amount, or NaN or infinite amount, in a single fused pass over the batch
+    return bool(((uid <= 0) | (pid <= 0) | (amt <= 0) | ~np.isfinite(amt)).any())
+
+def _skip_blank_rows(row) -> str:
+    # Skip whitespace-only lines (e.g. trailing indentation at the end of a file) but fail on any other malformed row
+    return 'skip' if not row.text.strip() else 'error'
+
+# Roll up every transaction inserted after the given rowid into per-user, per-day aggregates, merging them into any
+# existing day. COUNT, SUM, MAX and MIN all combine exactly across days, unlike AVG, so any date range can be answered from them
+_ROLLUP_SQL = """
+    INSERT INTO transactions_daily(user_id, day, cnt, sum_amt, max_amt, min_amt)
+        SELECT
+            user_id,
+            date(timestamp, 'unixepoch') as day,
+            COUNT(*),
+            SUM(transaction_amount),
+            MAX(transaction_amount),
+            MIN(transaction_amount)
+        FROM transactions
+        WHERE rowid > ?
+        GROUP BY user_id, day
+    ON CONFLICT(user_id, day) DO UPDATE SET
+        cnt = cnt + excluded.cnt,
+        sum_amt = sum_amt + excluded.sum_amt,
+        max_amt = MAX(max_amt, excluded.max_amt),
+        min_amt = MIN(min_amt, excluded.min_amt)
+"""
+
+# SQL query to extract the statistics we want from the daily aggregates for an unspecified user ID and date range.
+# Kept as one constant string so the connection's statement cache hands back the same prepared statement on every call
+_SUMMARY_SQL = """
+    SELECT 
+        SUM(cnt) as transaction_count,
+        MAX(max_amt) as max_amount,
+        MIN(min_amt) as min_amount,
+        SUM(sum_amt) as total_amount
+    FROM transactions_daily
+    WHERE user_id = ?
+    AND day >= ?
+    AND day <= ?
+"""
+
 class Database:
     ''' This class contains the database logic that the fastAPI endpoints 
         utilise to complete tasks such as upload or statistics summary. 
@@ -11,120 +87,225 @@ class Database:
         Uploading is done in chunks to ensure consistent memory usage,
         protecting against any unwanted side effects of attempting huge
         file uploads whilst maintaining performance.'''
-    CHUNK_SIZE=10000 # This constant determines the amount of rows processed within a single chunk when uploading a new CSV file
+    BLOCK_SIZE=1<<22 # This constant determines the amount of bytes of the input file parsed into a single chunk when uploading a new CSV file
+    ROW_SLICE=10000 # This constant determines the amount of rows converted to python objects at a time when inserting a chunk
+    DB_PATH='transactions.db' # This constant determines the file the sqlite database is stored in
+    SUMMARY_CACHE_SIZE=4096 # This constant determines how many summary results are kept in memory before the least recently used is evicted
+
+    # Per-connection settings - synchronous=NORMAL avoids an fsync on every commit once the database is in WAL mode.
+    # Automatic checkpoints are turned off as they would run inside the committing write. Writers call checkpoint()
+    # themselves once they have released the write lock instead.
+    # Reads go through a 1 GiB memory map of the database file and a page cache of up to 128 MiB
+    PRAGMAS=(
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA wal_autocheckpoint=0",
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA cache_size=-131072",
+        "PRAGMA mmap_size=1073741824",
+        "PRAGMA journal_size_limit=6144000",
+    )
 
     def __init__(self):
+        # Each worker thread keeps its own connection for the lifetime of the process, so reads never wait on an upload
+        self._local = threading.local()
+        # Writes are serialised on this lock, reads can run alongside them under WAL
+        self._write_lock = threading.Lock()
+        # LRU cache of summary results keyed by (user_id, start_date, end_date), emptied whenever the data changes.
+        # The version is bumped on every change so a summary computed from data that has since changed is never cached
+        self._summary_cache: OrderedDict[tuple, dict] = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._data_version = 0
         # Call database setup method
         self._init_db()
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        # Return the calling thread's connection, opening it on first use
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = self._connect()
+        return connection
+
+    def _invalidate_summaries(self):
+        # Drop every cached summary since changed rows may fall inside any cached date range
+        with self._cache_lock:
+            self._data_version += 1
+            self._summary_cache.clear()
+
+    def _connect(self) -> sqlite3.Connection:
+        # Open a connection in autocommit mode so transactions are only started when we ask for them.
+        # The statement cache keeps prepared statements alive between calls so repeated queries skip re-parsing
+        connection = sqlite3.connect(self.DB_PATH, isolation_level=None, check_same_thread=False,
+                                     cached_statements=256)
+
+        # Apply the per-connection settings
+        for pragma in self.PRAGMAS:
+            connection.execute(pragma)
+
+        return connection
     
     def _init_db(self):
-        # Establish database connection 
-        connection = sqlite3.connect('transactions.db')
+        connection = self._conn
+
+        # Switch the database file to write-ahead logging. This setting is persistent so only needs doing once
+        connection.execute("PRAGMA journal_mode=WAL")
 
         # Initialise cursor object to use for statement execution
         cursor = connection.cursor()
 
+        # Databases created before timestamps were stored as epoch seconds hold them as TEXT, so move that table aside to be converted
+        columns = {column[1]: column[2] for column in cursor.execute("PRAGMA table_info(transactions)")}
+        migrate = columns.get('timestamp') == 'TEXT'
+        if migrate:
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute("ALTER TABLE transactions RENAME TO transactions_text")
+
         # Create main table
         cursor.execute("""CREATE TABLE IF NOT EXISTS 
                             transactions(transaction_id TEXT PRIMARY KEY,
                                         user_id INTEGER, 
                                         product_id INTEGER, 
-                                        timestamp TEXT, 
+                                        timestamp INTEGER, 
                                         transaction_amount REAL)""")
 
-        # Commit database changes
-        connection.commit()
-        # Close connection
-        connection.close()
+        # Copy any old rows across, converting their timestamps to epoch seconds
+        if migrate:
+            cursor.execute("""INSERT INTO transactions
+                                SELECT transaction_id, user_id, product_id,
+                                       CAST(strftime('%s', timestamp) AS INTEGER), transaction_amount
+                                FROM transactions_text""")
+            cursor.execute("DROP TABLE transactions_text")
+            cursor.execute("COMMIT")
+
+        # Summaries are answered from the daily aggregates now, so the old per-transaction summary index is dead weight on inserts
+        cursor.execute("DROP INDEX IF EXISTS idx_tx_user_time_amt")
+
+        # Create the daily aggregates table, backfilling it from any existing transactions the first time it is created.
+        # Both happen in one transaction so a backfill cut short never leaves behind a table that looks complete
+        cursor.execute("BEGIN IMMEDIATE")
+        backfill = cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'transactions_daily'").fetchone() is None
+        cursor.execute("""CREATE TABLE IF NOT EXISTS
+                            transactions_daily(user_id INTEGER,
+                                               day TEXT,
+                                               cnt INTEGER,
+                                               sum_amt REAL,
+                                               max_amt REAL,
+                                               min_amt REAL,
+                                               PRIMARY KEY (user_id, day)) WITHOUT ROWID""")
+        if backfill:
+            cursor.execute(_ROLLUP_SQL, (0,))
+        cursor.execute("COMMIT")
+
+        # Checkpoint anything the migration or backfill wrote to the write-ahead log
+        self.checkpoint()
 
         print("Database Initialised")
 
+    def checkpoint(self):
+        # Copy committed pages from the write-ahead log back into the database file. A passive checkpoint never blocks
+        # readers or writers, so every write runs one after releasing the write lock instead of holding up its COMMIT
+        self._conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
     async def upload_csv(self, file: UploadFile) -> UploadResponse:
+        # Parse and insert in a worker thread so the event loop keeps serving other requests during large uploads
+        return await asyncio.to_thread(self._upload_csv_sync, file.file)
+
+    def _upload_csv_sync(self, file: BinaryIO) -> UploadResponse:
         # Take note of start time
         start=time.time()
-        connection = sqlite3.connect('transactions.db')
+        connection = self._conn
         cursor = connection.cursor()
-    
-        # Count rows before upload for later comparison to ascertain how many rows were added
-        cursor.execute("SELECT COUNT(*) FROM transactions")
-        rows_before = cursor.fetchone()[0]
+
+        # Only one upload or clear may write to the database at a time
+        self._write_lock.acquire()
 
         try:
-            # Use pandas to produce an iterator where each object contains CHUNK_SIZE lines from the input file
-            chunks = pd.read_csv(
-                    file.file,
-                    chunksize=self.CHUNK_SIZE,
-                    dtype={
-                        'transaction_id': str,
-                        'user_id': 'int32',
-                        'product_id': 'int32',
-                        'transaction_amount': 'float32'
-                    },
-                    parse_dates=['timestamp']
+            # Run the whole upload as one transaction so the only disk sync happens at the final COMMIT
+            connection.execute("BEGIN IMMEDIATE")
+
+            # Rows inserted by this upload will all be given a rowid above the current highest
+            last_rowid = cursor.execute("SELECT COALESCE(MAX(rowid), 0) FROM transactions").fetchone()[0]
+
+            # Use pyarrow's multi-threaded CSV reader to produce an iterator of record batches, each holding roughly BLOCK_SIZE bytes of the input file
+            batches = pacsv.open_csv(
+                    file,
+                    read_options=pacsv.ReadOptions(block_size=self.BLOCK_SIZE),
+                    parse_options=pacsv.ParseOptions(invalid_row_handler=_skip_blank_rows),
+                    convert_options=pacsv.ConvertOptions(column_types=_COLUMN_TYPES, strings_can_be_null=True,
+                                                         timestamp_parsers=[pacsv.ISO8601])
                 )
-            
-            first_chunk = True
-            # Iterate over each chunk, performing validation checks before converting the chunk to SQL and appending it to transactions table
-            for chunk in chunks:
-                # Check whether this is the first chunk to perform column validation
-                if first_chunk:
-                    expected_columns=['transaction_id', 'user_id', 'product_id', 
-                               'timestamp', 'transaction_amount']
-                    if list(chunk.columns) != expected_columns:
-                        raise ValueError(
-                            f"Invalid columns. Expected: {expected_columns}, "
-                            f"Got: {list(chunk.columns)}"
-                        )
-                    # Make sure first chunk flag is now false
-                    first_chunk=False
-
-                # Check whether the current chunk contains any null or empty values (ensures data integrity)
-                if chunk.isnull().any().any():
+
+            # Perform column validation against the header before reading any rows
+            expected_columns=list(_COLUMN_TYPES)
+            if batches.schema.names != expected_columns:
+                raise ValueError(
+                    f"Invalid columns. Expected: {expected_columns}, "
+                    f"Got: {batches.schema.names}"
+                )
+
+            # Keep a running total of how many rows were successfully appended to the transactions table
+            rows_inserted = 0
+
+            # Iterate over each batch, performing validation checks before converting the batch to SQL and appending it to transactions table
+            for batch in batches:
+                # Check whether the current batch contains any null or empty values (ensures data integrity).
+                # Arrow counts nulls while parsing so this needs no pass over the data
+                if any(column.null_count for column in batch.columns):
                     raise ValueError("CSV contains null/empty values")
-            
-                # Check that no values for 'transaction_amount' in the current chunk are negative
-                if (chunk['transaction_amount'] <= 0).any():
-                    raise ValueError("Transaction amounts must be positive")
-                
-                # Check that all user and product IDs are positive integers
-                if (chunk['user_id'] <= 0).any() or (chunk['product_id'] <= 0).any():
+
+                # Take zero-copy numpy views of the numeric columns so validation and row building share them
+                uid = batch.column('user_id').to_numpy()
+                pid = batch.column('product_id').to_numpy()
+                amt = batch.column('transaction_amount').to_numpy()
+
+                # Run every check in a single fused pass over the batch, only working out which one failed on the error path
+                if _has_invalid_values(uid, pid, amt):
+                    if np.isnan(amt).any():
+                        raise ValueError("CSV contains null/empty values")
+                    # Infinite amounts, including values too large for a float32, cannot be summarised
+                    if np.isinf(amt).any():
+                        raise ValueError("Transaction amounts must be finite")
+                    # Check that no values for 'transaction_amount' in the current batch are negative
+                    if (amt <= 0).any():
+                        raise ValueError("Transaction amounts must be positive")
+                    # Otherwise one of the user or product IDs is not a positive integer
                     raise ValueError("User ID and Product ID must be positive")
 
-                chunk.to_sql(
-                            'transactions',
-                            connection,
-                            if_exists='append',
-                            index=False
-                        ) 
-            
-            # Check how many rows are now in the transactions table after the upload is complete
-            cursor.execute("SELECT COUNT(*) FROM transactions")
-            rows_after = cursor.fetchone()[0]
-
-            # Compare this to rows before to ascertain how many rows were successfully appended to the transactions table
-            rows_inserted = rows_after - rows_before
+                # Stream the batch's rows into a single prepared statement. Rows whose transaction_id is already stored are
+                # skipped by the primary key check, so re-uploading an overlapping CSV only adds the new transactions
+                rows = _batch_rows(batch, uid, pid, amt, self.ROW_SLICE)
+                cursor.executemany("INSERT OR IGNORE INTO transactions VALUES (?, ?, ?, ?, ?)", rows)
+                # executemany reports the total number of rows actually inserted across the whole batch
+                rows_inserted += cursor.rowcount
+
+            # Fold the new rows into the daily aggregates inside the same transaction so both always agree
+            cursor.execute(_ROLLUP_SQL, (last_rowid,))
             # Commit the changes
-            connection.commit()
-        
-        # Catch pandas exception for empty files
-        except pd.errors.EmptyDataError:
-            raise ValueError("CSV file is empty")
+            connection.execute("COMMIT")
+            self._invalidate_summaries()
         
-        # Catch pandas exception for invalid file formatting
-        except pd.errors.ParserError as e:
+        # Catch pyarrow exceptions for empty files and invalid file formatting
+        except pa.ArrowInvalid as e:
+            if "Empty CSV file" in str(e):
+                raise ValueError("CSV file is empty")
             raise ValueError(f"Invalid CSV format: {str(e)}")
         
         # Catch any other exceptions
         except Exception as e:
-            # Make sure any changes that have been made are reverted
-            connection.rollback()
             raise ValueError(f"ERROR: {str(e)}")
 
         finally:
-            # Make sure the database connection is closed
-            connection.close()
-            # take note of the end time to calculate the total time of the upload later
-            end=time.time()
+            # If the upload failed part way through, make sure any changes that have been made are reverted
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+            # Make sure the write lock is released for the next writer
+            self._write_lock.release()
+
+        # Copy the upload from the write-ahead log into the database file now that other writers can proceed
+        self.checkpoint()
+        # take note of the end time to calculate the total time of the upload, including the checkpoint
+        end=time.time()
 
         # return a dict that follows the predefined UploadResponse pydantic model
         return {
@@ -135,62 +316,76 @@ class Database:
         }
 
 
-    def get_summary(self, user_id: int, start_date: str, end_date: str) -> SummaryResponse:
-        # Open database connection and initialise cursor
-        connection = sqlite3.connect('transactions.db')
-        cursor = connection.cursor()
+    def cached_summary(self, user_id: int, start_date: date, end_date: date) -> SummaryResponse | None:
+        # Return a cached summary, marking it as most recently used, or None if it has to be queried.
+        # This never touches the database so it is safe to call straight from the event loop
+        key = (user_id, start_date, end_date)
+        with self._cache_lock:
+            cached = self._summary_cache.get(key)
+            if cached is not None:
+                self._summary_cache.move_to_end(key)
+            return cached
 
-        # Define SQL query to extract the statistics we want from the transactions table for an unspecified user ID and date range
-        query = """
-            SELECT 
-                COUNT(*) as transaction_count,
-                MAX(transaction_amount) as max_amount,
-                MIN(transaction_amount) as min_amount,
-                AVG(transaction_amount) as mean_amount
-            FROM transactions
-            WHERE user_id = ?
-            AND timestamp >= ?
-            AND timestamp <= ?
-        """
-        
-        # Pass the user_id, start_date, and end_date variables to the query and execute
-        cursor.execute(query, (user_id, start_date, end_date))
-        # Fetch the result
-        result = cursor.fetchone()
-        connection.close()
+    def get_summary(self, user_id: int, start_date: date, end_date: date) -> SummaryResponse:
+        # Serve repeated requests straight from the cache, marking the entry as most recently used
+        key = (user_id, start_date, end_date)
+        with self._cache_lock:
+            cached = self._summary_cache.get(key)
+            if cached is not None:
+                self._summary_cache.move_to_end(key)
+                return cached
+            version = self._data_version
+
+        # Pass the user_id and date range to the query, execute and fetch the result. Days are stored as ISO strings
+        result = self._conn.execute(_SUMMARY_SQL, (user_id, start_date.isoformat(), end_date.isoformat())).fetchone()
 
         # Ensure that at least one transaction was found. If not, raise an error.
-        if result[0] == 0:
+        if not result[0]:
             raise ValueError(
                 f"No transactions found for user_id {user_id} "
                 f"between {start_date} and {end_date}"
             )
         
-        # Return the result in the SummaryResponse model format
-        return {
+        # Build the result in the SummaryResponse model format
+        summary = {
             "user_id": user_id,
             "transaction_count": result[0],
             "max_amount": result[1],
             "min_amount": result[2],
-            "mean_amount": round(result[3], 2), # Round mean average to 2 dp
+            "mean_amount": round(result[3] / result[0], 2), # Calculate the mean average from the total and round to 2 dp
             "start_date": start_date,
             "end_date": end_date
         }
+
+        # Cache the result unless the data changed while it was being computed, evicting the least recently used entry once the cache is full
+        with self._cache_lock:
+            if version == self._data_version:
+                self._summary_cache[key] = summary
+                if len(self._summary_cache) > self.SUMMARY_CACHE_SIZE:
+                    self._summary_cache.popitem(last=False)
+
+        return summary
     
     # This function was made for testing purposes as I encountered some issues during testing where simply deleting the transactions.db file was not sufficient to ensure values had not been cached
     def clear(self) -> ClearResponse:
-        # Establish database connection and initialise cursor
-        connection = sqlite3.connect('transactions.db')
-        cursor = connection.cursor()
+        # Delete transactions table contents, holding the write lock so this cannot interleave with an upload
+        with self._write_lock:
+            connection = self._conn
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                cursor = connection.execute("DELETE FROM transactions")
+                connection.execute("DELETE FROM transactions_daily")
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+            self._invalidate_summaries()
+
+        # Keep the write-ahead log from growing now that the write lock is released
+        self.checkpoint()
 
-        # Delete transactions table contents
-        cursor.execute("DELETE FROM transactions")
-        # Commit the deletion
-        connection.commit()
-        
         # Check how many rows were deleted
         rows_deleted = cursor.rowcount
-        connection.close()
         
         # Return relevent details in the ClearResponse model format
         return { "success":True,
@@ -1,6 +1,9 @@
-from app.main import app
+from app.main import app, db
+from app.storage import Database
 from fastapi.testclient import TestClient
+from datetime import date
 import io
+import sqlite3
 import pytest
 
 client=TestClient(app)
@@ -89,6 +92,18 @@ T001,42,100,2024-01-01 10:00:00,0.00
     
     assert response.status_code == 400
 
+@pytest.mark.parametrize("amount", ["inf", "1e39"])
+def test_upload_infinite_amount(amount):
+    # Test infinite amounts, and amounts that overflow to infinity, are rejected
+    csv_content = f"""transaction_id,user_id,product_id,timestamp,transaction_amount
+T001,42,100,2024-01-01 10:00:00,{amount}
+"""
+    files = {'file': ('test.csv', io.BytesIO(csv_content.encode()), 'text/csv')}
+    response = client.post("/upload", files=files)
+
+    assert response.status_code == 400
+    assert "finite" in response.json()["detail"].lower()
+
 @pytest.fixture
 def upload_test_data():
     """Pytest fixture that sets up the same set of test data before each test it is passed to as a parameter.
@@ -167,3 +182,140 @@ def test_summary_single_transaction(upload_test_data):
     assert data["max_amount"] == 200.00
     assert data["min_amount"] == 200.00
     assert data["mean_amount"] == 200.00
+
+
+def test_summary_updates_after_upload(upload_test_data):
+    # Test that a repeated summary reflects rows uploaded after the first request
+    response = client.get("/summary/43?start_date=2024-01-01&end_date=2024-12-31")
+    assert response.json()["transaction_count"] == 1
+
+    csv_content = """transaction_id,user_id,product_id,timestamp,transaction_amount
+T005,43,104,2024-01-11 14:00:00,100.00
+"""
+    files = {'file': ('test.csv', io.BytesIO(csv_content.encode()), 'text/csv')}
+    client.post("/upload", files=files)
+
+    response = client.get("/summary/43?start_date=2024-01-01&end_date=2024-12-31")
+    assert response.status_code == 200
+    data = response.json()
+    assert data["transaction_count"] == 2
+    assert data["min_amount"] == 100.00
+    assert data["mean_amount"] == 150.00
+
+
+def test_summary_end_date_inclusive(upload_test_data):
+    # Test that transactions made during the end date are included in the summary
+    response = client.get("/summary/42?start_date=2024-01-01&end_date=2024-02-20")
+    
+    assert response.status_code == 200
+    data = response.json()
+    assert data["transaction_count"] == 2
+    assert data["max_amount"] == 150.50
+    assert data["min_amount"] == pytest.approx(99.99)
+
+
+def test_upload_duplicate_transactions_skipped(upload_test_data):
+    # Test that re-uploaded transaction IDs are skipped and only new rows are counted
+    csv_content = """transaction_id,user_id,product_id,timestamp,transaction_amount
+T001,42,100,2024-01-15 10:00:00,99.99
+T005,42,104,2024-04-01 09:00:00,50.00
+"""
+    files = {'file': ('test.csv', io.BytesIO(csv_content.encode()), 'text/csv')}
+    response = client.post("/upload", files=files)
+
+    assert response.status_code == 200
+    assert response.json()["rows_processed"] == 1
+
+    response = client.get("/summary/42?start_date=2024-01-01&end_date=2024-12-31")
+    assert response.json()["transaction_count"] == 4
+    assert response.json()["min_amount"] == 50.00
+
+
+def _large_csv(rows: int) -> bytes:
+    # Build a valid CSV big enough to be spooled to disk by the upload parser
+    lines = ["transaction_id,user_id,product_id,timestamp,transaction_amount"]
+    lines += [f"L{i:07d},{i % 50 + 1},{i % 7 + 1},2024-05-{i % 28 + 1:02d} 08:00:00,{i % 100 + 1}.25" for i in range(rows)]
+    return ("\n".join(lines) + "\n").encode()
+
+
+def test_upload_large_file():
+    # Test an upload over 1 MiB, which the upload parser spools to disk
+    client.delete("/clear")
+    csv_content = _large_csv(100000)
+    assert len(csv_content) > 1 << 20
+
+    files = {'file': ('large.csv', io.BytesIO(csv_content), 'text/csv')}
+    response = client.post("/upload", files=files)
+
+    assert response.status_code == 200
+    assert response.json()["rows_processed"] == 100000
+
+    response = client.get("/summary/1?start_date=2024-05-01&end_date=2024-05-31")
+    assert response.json()["transaction_count"] == 2000
+
+
+def test_upload_large_stream_without_fileno():
+    # Test a large upload straight from an in-memory stream with no file descriptor
+    db.clear()
+    response = db._upload_csv_sync(io.BytesIO(_large_csv(100000)))
+
+    assert response["rows_processed"] == 100000
+
+
+def test_legacy_database_migrated(tmp_path, monkeypatch):
+    # Test that a database with TEXT timestamps is converted and backfilled into the daily aggregates on start up
+    db_path = tmp_path / "legacy.db"
+    connection = sqlite3.connect(db_path)
+    connection.execute("""CREATE TABLE transactions(transaction_id TEXT PRIMARY KEY,
+                                                    user_id INTEGER,
+                                                    product_id INTEGER,
+                                                    timestamp TEXT,
+                                                    transaction_amount REAL)""")
+    connection.executemany("INSERT INTO transactions VALUES (?, ?, ?, ?, ?)", [
+        ("T001", 42, 100, "2024-01-15 10:00:00", 99.99),
+        ("T002", 42, 101, "2024-02-20 11:00:00", 150.50),
+        ("T003", 42, 102, "2024-03-25 12:00:00", 75.25),
+        ("T004", 43, 103, "2024-01-10 13:00:00", 200.00),
+    ])
+    connection.commit()
+    connection.close()
+
+    monkeypatch.setattr(Database, "DB_PATH", str(db_path))
+    legacy_db = Database()
+
+    summary = legacy_db.get_summary(42, date(2024, 1, 1), date(2024, 2, 20))
+    assert summary["transaction_count"] == 2
+    assert summary["max_amount"] == 150.50
+    assert summary["min_amount"] == pytest.approx(99.99)
+    assert legacy_db._conn.execute("SELECT typeof(timestamp) FROM transactions").fetchone()[0] == "integer"
+
+
+def test_upload_fractional_seconds(upload_test_data):
+    # Test timestamps with fractional seconds are accepted and floored to the second
+    csv_content = """transaction_id,user_id,product_id,timestamp,transaction_amount
+T005,44,104,2024-01-01 23:59:59.5,10.00
+T006,44,105,2024-01-02 10:00:00.250,20.00
+"""
+    files = {'file': ('test.csv', io.BytesIO(csv_content.encode()), 'text/csv')}
+    response = client.post("/upload", files=files)
+
+    assert response.status_code == 200
+    assert response.json()["rows_processed"] == 2
+
+    response = client.get("/summary/44?start_date=2024-01-01&end_date=2024-01-01")
+    assert response.json()["transaction_count"] == 1
+    assert response.json()["max_amount"] == 10.00
+
+
+def test_summary_cache_hit_skips_query(upload_test_data, monkeypatch):
+    # Test a repeated summary is answered from the cache without running the query again
+    first = client.get("/summary/42?start_date=2024-01-01&end_date=2024-12-31")
+    assert first.status_code == 200
+
+    def fail(*args):
+        raise AssertionError("cache hit should not query the database")
+    monkeypatch.setattr(db, "get_summary", fail)
+
+    response = client.get("/summary/42?start_date=2024-01-01&end_date=2024-12-31")
+    assert response.status_code == 200
+    assert response.json() == first.json()